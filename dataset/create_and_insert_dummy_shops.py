@@ -1,15 +1,27 @@
 # Generates dummy shops, inserts into DynamoDB,
 # and saves merchant list + base revenue into dummy_shops.txt
 
+import itertools
 import random
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import boto3
+from botocore.config import Config
 
 # CONFIG
 AWS_REGION = "us-east-1"
 
+# DynamoDB client config: one pooled connection per BATCH_WRITE_WORKERS thread
+# (with headroom), and adaptive retries to back off on throttled batch writes
+BOTO_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
 SHOP_TO_USER_TABLE = "TrueProfitShopToUser-dev"
 INTEGRATIONS_TABLE = "TrueProfitIntegrations-dev"
 
@@ -21,6 +33,12 @@ SHOP_DOMAIN_SUFFIX = ".myshopify.com"
 
 OUTPUT_FILE = "dummy_shops.txt"
 
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_MAX_RETRIES = 8
+BATCH_WRITE_BASE_DELAY = 0.05
+BATCH_WRITE_WORKERS = 16
+
 # Base revenue range per shop
 BASE_REV_MIN = 500.0
 BASE_REV_MAX = 100000.0
@@ -36,39 +54,99 @@ def make_shop_name(idx: int) -> str:
     return f"{SHOP_PREFIX}-{idx:02d}-{rand_suffix(4)}{SHOP_DOMAIN_SUFFIX}"
 
 
+def chunked(iterable, size: int):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_batch(ddb, request_items):
+    # One BatchWriteItem call, resubmitting UnprocessedItems with backoff
+    attempt = 0
+    while True:
+        res = ddb.batch_write_item(RequestItems=request_items)
+        request_items = res.get("UnprocessedItems") or {}
+        if not request_items:
+            return
+        if attempt >= BATCH_WRITE_MAX_RETRIES:
+            pending = sum(len(v) for v in request_items.values())
+            raise RuntimeError(
+                f"BatchWriteItem left {pending} unprocessed items after {attempt} retries"
+            )
+        time.sleep(BATCH_WRITE_BASE_DELAY * (2**attempt))
+        attempt += 1
+
+
+def batch_write(ddb, writes):
+    """
+    writes: list of (table_name, {"PutRequest": {...}}) pairs.
+    Groups them into BatchWriteItem payloads of up to 25 requests and sends
+    the payloads concurrently. The low-level client is thread-safe, so all
+    workers share the same ddb client.
+    """
+    batches = []
+    for chunk in chunked(writes, BATCH_WRITE_MAX_ITEMS):
+        request_items = {}
+        for table, req in chunk:
+            request_items.setdefault(table, []).append(req)
+        batches.append(request_items)
+
+    with ThreadPoolExecutor(max_workers=BATCH_WRITE_WORKERS) as ex:
+        # list() drains the iterator so worker exceptions are re-raised here
+        list(ex.map(lambda items: write_batch(ddb, items), batches))
+
+
 def main():
-    ddb = boto3.client("dynamodb", region_name=AWS_REGION)
+    ddb = boto3.client("dynamodb", region_name=AWS_REGION, config=BOTO_CONFIG)
     now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
     shops_with_revenue = []
+    writes = []
 
     for i in range(NUM_SHOPS):
         shop = make_shop_name(i + 1)
         base_rev = round(random.uniform(BASE_REV_MIN, BASE_REV_MAX), 2)
         shops_with_revenue.append((shop, base_rev))
 
-        # Insert into ShopToUser table
-        ddb.put_item(
-            TableName=SHOP_TO_USER_TABLE,
-            Item={
-                "PK": {"S": f"SHOP#{shop}"},
-                "SK": {"S": f"USER#{USERNAME}"},
-                "Shop": {"S": shop},
-                "UserSub": {"S": USERNAME},
-                "CreatedAt": {"S": now},
-            },
+        # ShopToUser table
+        writes.append(
+            (
+                SHOP_TO_USER_TABLE,
+                {
+                    "PutRequest": {
+                        "Item": {
+                            "PK": {"S": f"SHOP#{shop}"},
+                            "SK": {"S": f"USER#{USERNAME}"},
+                            "Shop": {"S": shop},
+                            "UserSub": {"S": USERNAME},
+                            "CreatedAt": {"S": now},
+                        }
+                    }
+                },
+            )
         )
 
-        # Insert into Integrations table
-        ddb.put_item(
-            TableName=INTEGRATIONS_TABLE,
-            Item={
-                "PK": {"S": f"USER#{USERNAME}"},
-                "SK": {"S": f"SHOPIFY#{shop}"},
-                "Shop": {"S": shop},
-            },
+        # Integrations table
+        writes.append(
+            (
+                INTEGRATIONS_TABLE,
+                {
+                    "PutRequest": {
+                        "Item": {
+                            "PK": {"S": f"USER#{USERNAME}"},
+                            "SK": {"S": f"SHOPIFY#{shop}"},
+                            "Shop": {"S": shop},
+                        }
+                    }
+                },
+            )
         )
 
+    batch_write(ddb, writes)
+
     # Save output file
     with open(OUTPUT_FILE, "w") as f:
         for shop, rev in shops_with_revenue:
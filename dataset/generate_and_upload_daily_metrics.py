@@ -5,21 +5,39 @@
 # then uploads Parquet partitions to S3 under:
 #   s3://<BUCKET>/<S3_PREFIX>/dt=YYYY-MM-DD/shop_id=<shop>/part-....parquet
 
+import hashlib
+import io
+import json
 import os
+import secrets
 import shutil
-import uuid
+import time
 import zipfile
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
 
 import boto3
 import numpy as np
-import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 # CONFIG
 AWS_REGION = "us-east-1"
 
+# S3 and Athena client config: one pooled connection per UPLOAD_WORKERS
+# partition upload thread, and adaptive retries to back off on S3 throttling
+BOTO_CONFIG = Config(
+    max_pool_connections=64,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
 S3_BUCKET = "trueprofit-analytics-dev-893677978594"
 S3_PREFIX = "daily_metrics"
 
@@ -27,6 +45,8 @@ ATHENA_DATABASE = "trueprofit_analytics_dev"
 ATHENA_TABLE = "daily_metrics"
 ATHENA_WORKGROUP = "trueprofit-dev"
 ATHENA_OUTPUT_S3 = f"s3://{S3_BUCKET}/athena-results/"
+ATHENA_POLL_INITIAL_DELAY = 0.1
+ATHENA_POLL_MAX_DELAY = 2.0
 
 # Input shop file produced by create_dummy_shops.py
 # Each line: shop_domain,base_revenue
@@ -37,8 +57,30 @@ OUT_DIR = "daily_metrics"
 CSV_NAME = "daily_metrics.csv"
 PARQUET_DIRNAME = "parquet"
 ZIP_NAME = f"{PARQUET_DIRNAME}.zip"
+# Keep a local copy of the uploaded partitions (zipped at the end)
+SAVE_LOCAL_PARQUET = True
+# Records what was uploaded per partition so unchanged ones are skipped on re-runs
+UPLOAD_MANIFEST_NAME = "_uploaded.json"
+
+# Parquet encoding (each partition fits in a single row group)
+PARQUET_ROW_GROUP_SIZE = 500_000
+# Repeating string columns (one merchant per shop_id partition); the float
+# columns are near-unique, so a dictionary page would only add overhead
+PARQUET_DICTIONARY_COLUMNS = ["merchant_id", "metric_date"]
+
+# S3 upload tuning (many small partition files): 6 MiB parts instead of the
+# larger defaults, so big partitions go multipart early with small buffers
+UPLOAD_WORKERS = 64
+MULTIPART_PART_SIZE = 6 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_PART_SIZE,
+    multipart_chunksize=MULTIPART_PART_SIZE,
+    max_concurrency=16,
+    use_threads=True,
+)
 
 # Data generation knobs
+RANDOM_SEED = 0
 DAYS = 90
 NOISE_STD = 0.2
 WEEKEND_FACTOR = 0.85
@@ -51,6 +93,29 @@ SEASONAL = {
     7: 0.85,
     8: 0.85,
 }
+# Same multipliers as a lookup array indexed by month (1-12; index 0 unused)
+SEASONAL_ARR = np.array([SEASONAL.get(m, 1.0) for m in range(13)])
+
+# Parquet file schema; must match the Glue daily_metrics table columns
+GLUE_SCHEMA = pa.schema(
+    [
+        ("merchant_id", pa.string()),
+        ("metric_date", pa.string()),
+        ("gross_revenue", pa.float64()),
+        ("net_revenue", pa.float64()),
+        ("product_costs", pa.float64()),
+        ("marketing_costs", pa.float64()),
+        ("fulfillment_costs", pa.float64()),
+        ("processing_fees", pa.float64()),
+        ("other_costs", pa.float64()),
+    ]
+)
+# Full-row schema (debug CSV): Glue columns plus partition helpers (dt/shop_id),
+# which become S3 path segments and are not written into the files.
+# dt stays a date (datetime64[D] / date32); it is only formatted for the path.
+METRICS_SCHEMA = GLUE_SCHEMA.append(pa.field("dt", pa.date32())).append(
+    pa.field("shop_id", pa.string())
+)
 
 # Cost ratio ranges (as portion of gross)
 PRODUCT_COST_RANGE = (0.35, 0.45)
@@ -61,43 +126,76 @@ OTHER_COST_RANGE = (0.00, 0.03)
 
 
 def read_shops_with_base_revenue(path: str):
-    shops = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            parts = [p.strip() for p in line.split(",")]
-            if len(parts) != 2:
-                raise ValueError(
-                    f"Invalid line in {path}: {line!r} (expected 'shop,base_revenue')"
-                )
-            shop = parts[0]
-            base_rev = float(parts[1])
-            shops.append((shop, base_rev))
-    if not shops:
+    # Parsed by Arrow's C++ CSV reader; returns (shop_names, base_revenues)
+    # as NumPy arrays ready for generate_daily_metrics.
+    # Arrow only skips truly empty lines, so whitespace-only rows (which parse
+    # as one column) are skipped by the invalid-row handler; any other bad
+    # row still raises. Quoting is disabled, as in the old split(",") parser.
+    if os.path.getsize(path) == 0:
+        # Arrow rejects a zero-byte file as "Empty CSV file"
         raise ValueError(f"No shops found in {path}")
-    return shops
+    try:
+        table = pacsv.read_csv(
+            path,
+            read_options=pacsv.ReadOptions(column_names=["shop", "base_rev"]),
+            parse_options=pacsv.ParseOptions(
+                quote_char=False,
+                invalid_row_handler=lambda row: (
+                    "error" if (row.text or "").strip() else "skip"
+                ),
+            ),
+            convert_options=pacsv.ConvertOptions(
+                column_types={"shop": pa.string(), "base_rev": pa.float64()}
+            ),
+        )
+    except pa.ArrowInvalid as e:
+        raise ValueError(
+            f"Invalid {path}: {e} (expected 'shop,base_revenue' lines)"
+        ) from e
+    if table.num_rows == 0:
+        raise ValueError(f"No shops found in {path}")
+    if table["base_rev"].null_count:
+        raise ValueError(f"Missing base_revenue in {path}")
+
+    shop_names = pc.utf8_trim_whitespace(table["shop"]).to_numpy(zero_copy_only=False)
+    base_rev = table["base_rev"].to_numpy()
+    return shop_names, base_rev
 
 
 def ensure_dir(p: str):
     os.makedirs(p, exist_ok=True)
 
 
-def generate_rows_for_shop_day(shop: str, base_rev: float, day):
-    # day is a date object
-    seasonal_factor = SEASONAL.get(day.month, 1.0)
-    weekend_factor = WEEKEND_FACTOR if day.weekday() >= 5 else 1.0
+def generate_daily_metrics(
+    shop_names: np.ndarray,
+    base_rev: np.ndarray,
+    today,
+    rng: np.random.Generator,
+):
+    # Builds all SHOPS x DAYS rows at once with NumPy broadcasting.
+    # Arrays are shaped (S, D): one row per shop, one column per day.
+    # All randomness comes from bulk draws on the single rng.
+    s, d = len(shop_names), DAYS
+
+    # days[0] is today, days[i] is today - i
+    days = np.datetime64(today, "D") - np.arange(d).astype("timedelta64[D]")
+
+    months = days.astype("datetime64[M]").astype(int) % 12 + 1
+    seasonal = SEASONAL_ARR[months]
 
-    gross = base_rev * seasonal_factor * weekend_factor
-    gross *= 1 + np.random.normal(0, NOISE_STD)
-    gross = max(gross, 0.0)
+    # 1970-01-01 was a Thursday, so shift to Monday=0 like date.weekday()
+    weekday = (days.astype(int) - 4) % 7
+    weekend = np.where(weekday >= 5, WEEKEND_FACTOR, 1.0)
 
-    product_costs = gross * np.random.uniform(*PRODUCT_COST_RANGE)
-    marketing_costs = gross * np.random.uniform(*MARKETING_COST_RANGE)
-    fulfillment_costs = gross * np.random.uniform(*FULFILLMENT_COST_RANGE)
-    processing_fees = gross * np.random.uniform(*PROCESSING_FEES_RANGE)
-    other_costs = gross * np.random.uniform(*OTHER_COST_RANGE)
+    gross = base_rev[:, None] * seasonal[None, :] * weekend[None, :]
+    gross *= 1 + rng.normal(0, NOISE_STD, (s, d))
+    gross = np.maximum(gross, 0.0)
+
+    product_costs = gross * rng.uniform(*PRODUCT_COST_RANGE, (s, d))
+    marketing_costs = gross * rng.uniform(*MARKETING_COST_RANGE, (s, d))
+    fulfillment_costs = gross * rng.uniform(*FULFILLMENT_COST_RANGE, (s, d))
+    processing_fees = gross * rng.uniform(*PROCESSING_FEES_RANGE, (s, d))
+    other_costs = gross * rng.uniform(*OTHER_COST_RANGE, (s, d))
 
     net = gross - (
         product_costs
@@ -107,80 +205,174 @@ def generate_rows_for_shop_day(shop: str, base_rev: float, day):
         + other_costs
     )
 
-    day_str = day.strftime("%Y-%m-%d")
+    # Round every money column to cents in place, one vector op each
+    for arr in (
+        gross,
+        net,
+        product_costs,
+        marketing_costs,
+        fulfillment_costs,
+        processing_fees,
+        other_costs,
+    ):
+        np.round(arr, 2, out=arr)
+
+    # Flatten row-major so rows stay grouped by shop, newest day first
+    shop_col = np.repeat(shop_names, d)
+    dt_col = np.tile(days, s)
+    # metric_date is a string column in Glue; format each day once, then tile
+    day_col = np.tile(np.datetime_as_string(days, unit="D"), s)
+
+    # Flat 1-D columns keyed by METRICS_SCHEMA names
     return {
         # Glue columns
-        "merchant_id": shop,
-        "metric_date": day_str,
-        "gross_revenue": round(gross, 2),
-        "net_revenue": round(net, 2),
-        "product_costs": round(product_costs, 2),
-        "marketing_costs": round(marketing_costs, 2),
-        "fulfillment_costs": round(fulfillment_costs, 2),
-        "processing_fees": round(processing_fees, 2),
-        "other_costs": round(other_costs, 2),
+        "merchant_id": shop_col,
+        "metric_date": day_col,
+        "gross_revenue": gross.ravel(),
+        "net_revenue": net.ravel(),
+        "product_costs": product_costs.ravel(),
+        "marketing_costs": marketing_costs.ravel(),
+        "fulfillment_costs": fulfillment_costs.ravel(),
+        "processing_fees": processing_fees.ravel(),
+        "other_costs": other_costs.ravel(),
         # Partition helpers (not part of Glue columns)
-        "dt": day_str,
-        "shop_id": shop,
+        "dt": dt_col,
+        "shop_id": shop_col,
     }
 
 
+def load_manifest(path: str) -> dict:
+    # Maps s3://bucket/<partition prefix> -> {"key": ..., "md5": ...}
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(path: str, manifest: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def s3_object_exists(s3, bucket: str, key: str) -> bool:
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
 def df_to_parquet_partitioned_and_upload(
-    df: pd.DataFrame, local_parquet_root: str, s3_bucket: str, s3_prefix: str
+    columns: dict[str, np.ndarray],
+    local_parquet_root: str,
+    s3_bucket: str,
+    s3_prefix: str,
+    save_local: bool = False,
+    manifest_path: Optional[str] = None,
 ):
     """
-    Writes parquet files to:
+    Serializes each partition to parquet in memory and uploads it to:
+      s3://bucket/<s3_prefix>/dt=YYYY-MM-DD/shop_id=<shop>/part-....parquet
+    With save_local=True, also keeps a copy under:
       <local_parquet_root>/dt=YYYY-MM-DD/shop_id=<shop>/part-....parquet
-    Then uploads to:
-      s3://bucket/<s3_prefix>/dt=.../shop_id=.../part-....parquet
+    With manifest_path, partitions whose bytes match the last upload recorded
+    there (and whose object still exists) are skipped.
+    Returns (uploaded, skipped).
     """
-    s3 = boto3.client("s3", region_name=AWS_REGION)
-    uploaded = 0
+    s3 = boto3.client("s3", region_name=AWS_REGION, config=BOTO_CONFIG)
 
     # Ensure prefix formatting
     prefix = s3_prefix.strip().strip("/")
     # Local root
-    ensure_dir(local_parquet_root)
-
-    # Only write Glue columns into parquet (NOT dt/shop_id)
-    glue_cols = [
-        "merchant_id",
-        "metric_date",
-        "gross_revenue",
-        "net_revenue",
-        "product_costs",
-        "marketing_costs",
-        "fulfillment_costs",
-        "processing_fees",
-        "other_costs",
-    ]
-
-    grouped = df.groupby(["dt", "shop_id"], sort=False)
-    for (dt_str, shop), g in grouped:
-        part_dir = os.path.join(local_parquet_root, f"dt={dt_str}", f"shop_id={shop}")
-        ensure_dir(part_dir)
-
-        fname = f"part-{uuid.uuid4().hex[:12]}.parquet"
-        local_path = os.path.join(part_dir, fname)
-
-        table = pa.Table.from_pandas(g[glue_cols], preserve_index=False)
-        pq.write_table(table, local_path, compression=None)
-
-        s3_key = (
-            f"{prefix}/dt={dt_str}/shop_id={shop}/{fname}"
-            if prefix
-            else f"dt={dt_str}/shop_id={shop}/{fname}"
+    if save_local:
+        ensure_dir(local_parquet_root)
+
+    manifest = load_manifest(manifest_path) if manifest_path else {}
+    skipped = []
+
+    # Encode (dt, shop_id) as one integer key, argsort it once, and find each
+    # partition's [start, end) run in the sorted order with searchsorted
+    dts = columns["dt"]
+    shop_names, shop_codes = np.unique(columns["shop_id"], return_inverse=True)
+    key = dts.astype(np.int64) * len(shop_names) + shop_codes
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+    part_keys = np.unique(sorted_key)
+    starts = np.searchsorted(sorted_key, part_keys, side="left")
+    ends = np.searchsorted(sorted_key, part_keys, side="right")
+
+    def upload_partition(start_end):
+        start, end = start_end
+        idx = order[start:end]
+        dt, shop = dts[idx[0]], columns["shop_id"][idx[0]]
+        part_rel = f"dt={dt}/shop_id={shop}"
+        part_prefix = f"{prefix}/{part_rel}" if prefix else part_rel
+        manifest_key = f"s3://{s3_bucket}/{part_prefix}"
+
+        # Only write Glue columns into parquet (NOT dt/shop_id)
+        buf = pa.BufferOutputStream()
+        pq.write_table(
+            pa.Table.from_arrays(
+                [columns[name][idx] for name in GLUE_SCHEMA.names],
+                schema=GLUE_SCHEMA,
+            ),
+            buf,
+            compression="ZSTD",
+            compression_level=1,
+            use_dictionary=PARQUET_DICTIONARY_COLUMNS,
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
         )
-        s3.upload_file(local_path, s3_bucket, s3_key)
-        uploaded += 1
-
-    return uploaded
+        body = buf.getvalue()
+        md5 = hashlib.md5(body, usedforsecurity=False).hexdigest()
+
+        # A partition keeps one object: changed bytes overwrite the recorded
+        # key, so Athena never sees a stale file next to the new one
+        prev = manifest.get(manifest_key)
+        if prev and prev["md5"] == md5 and s3_object_exists(s3, s3_bucket, prev["key"]):
+            s3_key = prev["key"]
+            skipped.append(s3_key)
+        else:
+            if prev:
+                s3_key = prev["key"]
+            else:
+                s3_key = f"{part_prefix}/part-{secrets.token_hex(6)}.parquet"
+            if body.size < MULTIPART_PART_SIZE:
+                # Typical partitions are a few KB: one PUT, no TransferManager
+                s3.put_object(Bucket=s3_bucket, Key=s3_key, Body=body.to_pybytes())
+            else:
+                s3.upload_fileobj(
+                    io.BytesIO(body), s3_bucket, s3_key, Config=TRANSFER_CONFIG
+                )
+            manifest[manifest_key] = {"key": s3_key, "md5": md5}
+
+        if save_local:
+            fname = s3_key.rsplit("/", 1)[-1]
+            part_dir = os.path.join(local_parquet_root, f"dt={dt}", f"shop_id={shop}")
+            ensure_dir(part_dir)
+            with open(os.path.join(part_dir, fname), "wb") as f:
+                f.write(body)
+
+    # Encoding releases the GIL and uploads are network-bound, so run both
+    # on the pool; the boto3 client is thread-safe so share it
+    partitions = list(zip(starts, ends))
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+            list(pool.map(upload_partition, partitions))
+    finally:
+        # Record whatever did upload even if another partition failed, so the
+        # next run overwrites those keys instead of adding duplicates
+        if manifest_path:
+            save_manifest(manifest_path, manifest)
+
+    return len(partitions) - len(skipped), len(skipped)
 
 
 def run_athena_query(
     sql: str, db: str, workgroup: str, output_s3: str, region: str, timeout: int = 120
 ) -> str:
-    ath = boto3.client("athena", region_name=region)
+    ath = boto3.client("athena", region_name=region, config=BOTO_CONFIG)
 
     start = ath.start_query_execution(
         QueryString=sql,
@@ -190,9 +382,11 @@ def run_athena_query(
     )
     qid = start["QueryExecutionId"]
 
-    # poll
-    deadline = datetime.now().timestamp() + timeout
-    while datetime.now().timestamp() < deadline:
+    # poll with exponential backoff: fast queries (e.g. MSCK REPAIR) return
+    # in well under a second, slow ones back off to ATHENA_POLL_MAX_DELAY
+    delay = ATHENA_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         res = ath.get_query_execution(QueryExecutionId=qid)
         state = res["QueryExecution"]["Status"]["State"]
         if state in ("SUCCEEDED", "FAILED", "CANCELLED"):
@@ -200,10 +394,8 @@ def run_athena_query(
                 reason = res["QueryExecution"]["Status"].get("StateChangeReason", "")
                 raise RuntimeError(f"Athena query {state}: {reason} (qid={qid})")
             return qid
-        # ~1s sleep without importing time heavily (tiny)
-        import time
-
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(delay * 1.5, ATHENA_POLL_MAX_DELAY)
 
     raise RuntimeError(f"Athena query timed out (qid={qid})")
 
@@ -219,36 +411,47 @@ def zip_folder(src_folder: str, zip_path: str):
 
 
 def main():
+    rng = np.random.default_rng(seed=RANDOM_SEED)
+
     # Read shops + base revenue
-    shops = read_shops_with_base_revenue(SHOPS_FILE)
+    shop_names, base_rev = read_shops_with_base_revenue(SHOPS_FILE)
 
-    # Generate dataframe
+    # Generate metric columns
     today = datetime.now().date()
-    rows = []
-
-    for shop, base_rev in shops:
-        for i in range(DAYS):
-            day = today - timedelta(days=i)
-            rows.append(generate_rows_for_shop_day(shop, base_rev, day))
-
-    df = pd.DataFrame(rows)
+    columns = generate_daily_metrics(shop_names, base_rev, today, rng)
 
     # Local outputs
     ensure_dir(OUT_DIR)
 
     # Save CSV (readable) including partitions to help debugging
     csv_path = os.path.join(OUT_DIR, CSV_NAME)
-    df.to_csv(csv_path, index=False)
+    # Values never contain commas or quotes, so the header and rows are written
+    # unquoted like the previous pandas output (write_csv raises if that ever
+    # stops being true). Unlike pandas, whole-number floats print as 20, not 20.0
+    pacsv.write_csv(
+        pa.Table.from_pydict(columns, schema=METRICS_SCHEMA),
+        csv_path,
+        write_options=pacsv.WriteOptions(
+            include_header=True, quoting_style="none", quoting_header="none"
+        ),
+    )
     print("Saved CSV:", csv_path)
 
     # Save parquet partitioned + upload to S3
     local_parquet_root = os.path.join(OUT_DIR, PARQUET_DIRNAME)
-    uploaded = df_to_parquet_partitioned_and_upload(
-        df, local_parquet_root, S3_BUCKET, S3_PREFIX
+    uploaded, skipped = df_to_parquet_partitioned_and_upload(
+        columns,
+        local_parquet_root,
+        S3_BUCKET,
+        S3_PREFIX,
+        save_local=SAVE_LOCAL_PARQUET,
+        manifest_path=os.path.join(OUT_DIR, UPLOAD_MANIFEST_NAME),
     )
 
-    print("Saved Parquet partitions locally:", local_parquet_root)
+    if SAVE_LOCAL_PARQUET:
+        print("Saved Parquet partitions locally:", local_parquet_root)
     print(f"Uploaded {uploaded} Parquet objects to s3://{S3_BUCKET}/{S3_PREFIX}/")
+    print(f"Skipped {skipped} unchanged Parquet objects")
 
     # Run repair
     repair_sql = f"MSCK REPAIR TABLE {ATHENA_TABLE};"
@@ -257,6 +460,9 @@ def main():
     )
     print(f"Ran Athena repair: {repair_sql}  (qid={qid})")
 
+    if not SAVE_LOCAL_PARQUET:
+        return
+
     # Zip parquet folder then delete it
     zip_path = os.path.join(OUT_DIR, ZIP_NAME)
     zip_folder(local_parquet_root, zip_path)